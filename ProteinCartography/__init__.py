@@ -1,47 +1,38 @@
+import importlib
+
 __all__ = ["aggregate_features",
-           "aggregate_lists", 
+           "aggregate_foldseek_fraction_seq_identity",
+           "aggregate_lists",
+           "assess_pdbs",
            "calculate_concordance",
            "cluster_similarity",
            "dim_reduction",
-           "esmfold_apiquery", 
+           "esmfold_apiquery",
            "extract_blasthits",
            "extract_foldseekhits",
            "extract_input_distances",
            "fetch_accession",
+           "fetch_uniprot_metadata",
+           "filter_uniprot_hits",
            "foldseek_apiquery",
            "foldseek_clustering",
            "get_source",
+           "leiden_clustering",
            "make_dummies",
            "map_refseqids",
+           "prep_pdbpaths",
            "plot_interactive",
-           "plot_structure_pair",
-           "query_uniprot",
            "rescue_mapping",
-           "run_blast"]
+           "run_blast",
+           "semantic_analysis"]
+
+
+# submodules are only imported when first accessed, so importing one script
+# doesn't pull in the heavy dependencies of all the others
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-from .aggregate_features import *
-from .aggregate_foldseek_fraction_seq_identity import *
-from .aggregate_lists import *
-from .assess_pdbs import *
-from .calculate_concordance import *
-from .cluster_similarity import *
-from .dim_reduction import *
-from .esmfold_apiquery import *
-from .extract_blasthits import *
-from .extract_foldseekhits import *
-from .extract_input_distances import *
-from .fetch_accession import *
-from .fetch_uniprot_metadata import *
-from .filter_uniprot_hits import *
-from .foldseek_apiquery import *
-from .foldseek_clustering import *
-from .get_source import *
-from .leiden_clustering import *
-from .make_dummies import *
-from .map_refseqids import *
-from .prep_pdbpaths import *
-from .plot_interactive import *
-from .py3dmol_plot import *
-from .rescue_mapping import *
-from .run_blast import *
-from .semantic_analysis import *
+    module = importlib.import_module(f".{name}", __name__)
+    globals()[name] = module
+    return module
@@ -1,10 +1,16 @@
 #!/usr/bin/env python
-from bioservices import UniProt
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from requests import get, post
+import random
+import re
+import requests
+from requests.adapters import HTTPAdapter, Retry
+import sqlite3
 from time import sleep
 import sys
+from urllib.parse import urlencode
+import warnings
 
 # only import these functions when using import *
 __all__ = ["map_refseqids_bioservices", "map_refseqids_rest"]
@@ -12,18 +18,53 @@ __all__ = ["map_refseqids_bioservices", "map_refseqids_rest"]
 # check through these default databases
 DEFAULT_DBS = ["EMBL-GenBank-DDBJ_CDS", "RefSeq_Protein"]
 
+# accession formats accepted by each database; ids that don't match aren't submitted
+DB_PATTERNS = {
+    "RefSeq_Protein": re.compile(r"^[NXYWAZ]P_\d+(\.\d+)?$"),
+    "EMBL-GenBank-DDBJ_CDS": re.compile(r"^[A-Z]{3}\d+(\.\d+)?$"),
+}
+
 # id mapping link
 UNIPROT_IDMAPPING_API = "https://rest.uniprot.org/idmapping"
 
+# maximum number of ids UniProt accepts in a single ID mapping job
+BATCH_SIZE = 100000
+
+# maximum number of ID mapping jobs to poll at the same time
+MAX_WORKERS = 8
+
+# maximum number of ids to look up in the cache per query
+CACHE_QUERY_SIZE = 900
+
 # requests constants
 REQUESTS_TRIES = 0
 REQUESTS_LIMIT = 10
 REQUESTS_SLEEP_TIME = 30
 
+# polling backs off exponentially from the initial sleep time up to REQUESTS_SLEEP_TIME
+REQUESTS_INITIAL_SLEEP_TIME = 1.0
+REQUESTS_BACKOFF_FACTOR = 1.7
+REQUESTS_JITTER = 0.5
+REQUESTS_TIMEOUT = REQUESTS_LIMIT * REQUESTS_SLEEP_TIME
+
 REQUESTS_HEADER = {
     "User-Agent": "ProteinCartography/0.4 (Arcadia Science) python-requests/2.0.1",
 }
 
+# reuse one pooled session so polls don't each pay for a new connection
+SESSION = requests.Session()
+SESSION.headers.update(REQUESTS_HEADER)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]
+        ),
+    ),
+)
+
 
 # parse command line arguments
 def parse_args():
@@ -47,78 +88,256 @@ def parse_args():
         default=DEFAULT_DBS,
         help=f"which databases to use for mapping. defaults to {DEFAULT_DBS}",
     )
-    parser.add_argument("-s", "--service", default="rest", help="how to fetch mapping")
+    parser.add_argument(
+        "-s",
+        "--service",
+        default="rest",
+        help="how to fetch mapping. 'bioservices' is deprecated and uses the REST API.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        default=None,
+        help="path to a SQLite file used to cache successful mappings between runs. delete it to refresh cached mappings.",
+    )
     args = parser.parse_args()
     return args
 
 
-# takes a list of IDs and maps them to Uniprot using bioservices
-# might make a more generalizable version of this and put it somewhere else
+def batch_ids(ids: list, batch_size=BATCH_SIZE) -> list:
+    """
+    Splits a list of ids into batches small enough for a single ID mapping job.
+
+    Args:
+        ids (list): list of accessions.
+        batch_size (int): maximum number of accessions per batch.
+
+    Returns:
+        a list of lists of accessions.
+    """
+    return [ids[i : i + batch_size] for i in range(0, len(ids), batch_size)]
+
+
+def open_idmapping_cache(cache_file: str) -> sqlite3.Connection:
+    """
+    Opens (and creates if needed) a SQLite cache of ID mapping results.
+
+    Args:
+        cache_file (str): path to the SQLite cache file.
+
+    Returns:
+        a sqlite3.Connection to the cache.
+    """
+    conn = sqlite3.connect(cache_file, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA cache_size=-65536")
+
+    # only successful mappings are stored, so unmapped ids are always resubmitted
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idmap (
+            db TEXT NOT NULL,
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            PRIMARY KEY (db, source, target)
+        )
+        """
+    )
+
+    return conn
+
+
+def read_idmapping_cache(conn: sqlite3.Connection, db: str, ids: list) -> list:
+    """
+    Looks up previously mapped ids in the cache.
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache.
+        db (str): database the accessions come from.
+        ids (list): list of accessions to look up.
+
+    Returns:
+        a list of (source, target) tuples for the ids found in the cache.
+    """
+    rows = []
+
+    for batch in batch_ids(ids, CACHE_QUERY_SIZE):
+        placeholders = ",".join("?" * len(batch))
+        rows.extend(
+            conn.execute(
+                f"SELECT source, target FROM idmap WHERE db = ? AND source IN ({placeholders})",
+                [db, *batch],
+            )
+        )
+
+    return rows
+
+
+def write_idmapping_cache(conn: sqlite3.Connection, db: str, pairs: list):
+    """
+    Saves the successful mappings of an ID mapping job to the cache.
+
+    Args:
+        conn (sqlite3.Connection): connection to the cache.
+        db (str): database the accessions come from.
+        pairs (list): list of (source, target) tuples returned by the job.
+    """
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO idmap (db, source, target) VALUES (?, ?, ?)",
+            ((db, source, target) for source, target in pairs),
+        )
+
+
+# kept for backwards compatibility; the REST implementation replaces bioservices
 def map_refseqids_bioservices(
     input_file: str, output_file: str, query_dbs: list, return_full=False
 ):
     """
-    Takes an input .txt file of accessions and maps to UniProt accessions.
+    Deprecated alias of map_refseqids_rest.
+    bioservices.UniProt.mapping wraps the same Uniprot ID mapping API,
+    so this now forwards to the REST implementation.
+    The full results have "from" and "to" columns rather than normalized bioservices json.
 
     Args:
         input_file (str): path to input .txt file containing one accession per line.
         output_file (str): path to destination .txt file.
         query_dbs (list): list of valid databases to query using the Uniprot ID mapping API.
-            Each database will be queried individually.
-            The results are compiled and unique results are printed to output_file.
+        return_full (bool): whether to return all of the results as a dataframe
     """
+    warnings.warn(
+        "map_refseqids_bioservices is deprecated; use map_refseqids_rest instead.",
+        DeprecationWarning,
+        stacklevel=2,
+    )
 
-    # make object that references UniProt database
-    u = UniProt()
+    return map_refseqids_rest(input_file, output_file, query_dbs, return_full)
 
-    # open the input file to extract ids
-    with open(input_file, "r") as f:
-        ids = f.read().splitlines()
 
-    if len(ids) > 100000:
-        ids = ids[0:100000]
+# Example curl POST request
+"""
+% curl --request POST 'https://rest.uniprot.org/idmapping/run' --form 'ids="P21802,P12345"' --form 'from="UniProtKB_AC-ID"' --form 'to="UniRef90"'
+"""
 
-    # make an empty collector dataframe for mapping
-    dummy_df = pd.DataFrame()
 
-    # for each query database, map
-    for i, db in enumerate(query_dbs):
-        # u.mapping returns a gross json file
-        results = u.mapping(db, "UniProtKB", query=",".join(ids))
+def submit_idmapping_job(input_string: str, db: str) -> str:
+    """
+    Submits an ID mapping job to the Uniprot ID mapping API.
 
-        # pandas can normalize the json and make it more tractable
-        results_df = pd.json_normalize(results["results"])
+    Args:
+        input_string (str): comma-separated string of accessions to map.
+        db (str): database the accessions come from.
 
-        # if there are no results, move on
-        if len(results_df) == 0:
-            continue
+    Returns:
+        the jobId of the submitted job.
+    """
+    # encode the (potentially very large) form body once up front
+    body = urlencode({"ids": input_string, "from": db, "to": "UniProtKB"}).encode()
 
-        # if it's the first database, replace it with the dummy dataframe
-        if i == 0:
-            dummy_df = results_df
-        # otherwise append to the dataframe
-        else:
-            dummy_df = pd.concat([dummy_df, results_df], axis=0)
+    ticket = SESSION.post(
+        f"{UNIPROT_IDMAPPING_API}/run",
+        data=body,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    ).json()
 
-    # extract just the unique Uniprot accessions
-    hits = dummy_df["to.primaryAccession"].unique()
+    return ticket["jobId"]
 
-    # save those accessions to a .txt file
-    with open(output_file, "w+") as f:
-        f.writelines(hit + "\n" for hit in hits)
 
-    if return_full:
-        return dummy_df
+def wait_for_idmapping_job(job_id: str):
+    """
+    Polls an ID mapping job until it is finished, exiting if it doesn't finish in time.
 
+    Args:
+        job_id (str): jobId returned by the Uniprot ID mapping API.
+    """
+    # poll until the job was successful or the time budget runs out
+    repeat = True
+    tries = REQUESTS_TRIES
+    delay = REQUESTS_INITIAL_SLEEP_TIME
+    waited = 0
+    while repeat and waited < REQUESTS_TIMEOUT:
+        status = SESSION.get(f"{UNIPROT_IDMAPPING_API}/status/{job_id}").json()
+        tries += 1
+        repeat = "results" not in status
+
+        if repeat:
+            # back off exponentially between poll requests, with jitter
+            sleep_time = min(delay, REQUESTS_SLEEP_TIME) + random.uniform(
+                0, REQUESTS_JITTER
+            )
+            sleep(sleep_time)
+            waited += sleep_time
+            delay *= REQUESTS_BACKOFF_FACTOR
+
+    if repeat:
+        sys.exit(
+            f"The ticket failed to complete after {tries} tries and {waited:.0f} seconds."
+        )
+
+
+def stream_idmapping_pairs(job_id: str):
+    """
+    Waits for an ID mapping job to finish and streams back its results.
+    Results are read line by line as tsv, so no json is parsed and
+    the full payload is never held in memory.
+
+    Args:
+        job_id (str): jobId returned by the Uniprot ID mapping API.
+
+    Yields:
+        a (source, Uniprot accession) tuple for each mapping.
+    """
+    wait_for_idmapping_job(job_id)
+
+    with SESSION.get(
+        f"{UNIPROT_IDMAPPING_API}/stream/{job_id}",
+        params={"format": "tsv"},
+        stream=True,
+    ) as response:
+        response.raise_for_status()
+        lines = response.iter_lines(decode_unicode=True)
+
+        # skip the "From\tTo" header
+        next(lines, None)
+
+        for line in lines:
+            if line:
+                source, target = line.split("\t")[:2]
+                yield source, target
 
-# Example curl POST request
-"""
-% curl --request POST 'https://rest.uniprot.org/idmapping/run' --form 'ids="P21802,P12345"' --form 'from="UniProtKB_AC-ID"' --form 'to="UniRef90"'
-"""
+
+def fetch_idmapping_results(job_id: str) -> list:
+    """
+    Waits for an ID mapping job to finish and retrieves its full results.
+
+    Args:
+        job_id (str): jobId returned by the Uniprot ID mapping API.
+
+    Returns:
+        a list of (source, Uniprot accession) tuples.
+    """
+    return list(stream_idmapping_pairs(job_id))
+
+
+def fetch_idmapping_hits(job_id: str) -> set:
+    """
+    Waits for an ID mapping job to finish and retrieves its unique mappings.
+
+    Args:
+        job_id (str): jobId returned by the Uniprot ID mapping API.
+
+    Returns:
+        a set of (source, Uniprot accession) tuples.
+    """
+    return set(stream_idmapping_pairs(job_id))
 
 
 def map_refseqids_rest(
-    input_file: str, output_file: str, query_dbs: list, return_full=False
+    input_file: str,
+    output_file: str,
+    query_dbs: list,
+    return_full=False,
+    cache_file=None,
 ):
     """
     Takes an input .txt file of accessions and maps to UniProt accessions.
@@ -130,63 +349,80 @@ def map_refseqids_rest(
             Each database will be queried individually.
             The results are compiled and unique results are printed to output_file.
         return_full (bool): whether to return all of the results as a dataframe
+        cache_file (str): optional path to a SQLite cache of previous mappings.
+            Only uncached ids are submitted, and new mappings are added to the cache.
+            Ids that didn't map are never cached. Delete the file to refresh it.
     """
     # open the input file to extract ids
     with open(input_file, "r") as f:
         input_lines = f.read().splitlines()
         input_ids = list(set(input_lines))
-        input_string = ",".join(input_ids)
-
-    dummy_df = pd.DataFrame()
-
-    for i, db in enumerate(query_dbs):
-        ticket = post(
-            f"{UNIPROT_IDMAPPING_API}/run",
-            {"ids": input_string, "from": db, "to": "UniProtKB"},
-            headers=REQUESTS_HEADER,
-        ).json()
-
-        # poll until the job was successful or failed
-        repeat = True
-        tries = REQUESTS_TRIES
-        limit = REQUESTS_LIMIT
-        sleep_time = REQUESTS_SLEEP_TIME
-        while repeat and tries < limit:
-            status = get(
-                f'{UNIPROT_IDMAPPING_API}/status/{ticket["jobId"]}',
-                headers=REQUESTS_HEADER,
-            ).json()
-
-            # wait a short time between poll requests
-            sleep(sleep_time)
-            tries += 1
-            repeat = "results" not in status
 
-        if tries == 10:
-            sys.exit(
-                f"The ticket failed to complete after {tries * sleep_time} seconds."
-            )
+    conn = open_idmapping_cache(cache_file) if cache_file is not None else None
+    cached_pairs = []
+
+    # only submit the ids that match each database and aren't already cached
+    jobs = []
+    for db in query_dbs:
+        query_ids = input_ids
 
-        results = get(f'{UNIPROT_IDMAPPING_API}/stream/{ticket["jobId"]}').json()
-        results_df = pd.DataFrame(results["results"])
+        if db in DB_PATTERNS:
+            query_ids = [i for i in query_ids if DB_PATTERNS[db].match(i)]
 
-        # if there are no results, move on
-        if len(results_df) == 0:
-            continue
+        if conn is not None:
+            cached = read_idmapping_cache(conn, db, query_ids)
+            cached_pairs.extend(cached)
+            cached_sources = {source for source, _ in cached}
+            query_ids = [i for i in query_ids if i not in cached_sources]
 
-        # if it's the first database, replace it with the dummy dataframe
-        if i == 0:
-            dummy_df = results_df
-        # otherwise append to the dataframe
-        else:
-            dummy_df = pd.concat([dummy_df, results_df], axis=0)
+        jobs.extend((db, batch) for batch in batch_ids(query_ids))
 
-    # extract just the unique Uniprot accessions
-    hits = dummy_df["to"].unique()
+    # submit a job for every database and batch up front so they run in parallel
+    job_ids = [submit_idmapping_job(",".join(batch), db) for db, batch in jobs]
+
+    # poll all of the jobs concurrently, keeping results in submission order
+    max_workers = max(min(len(job_ids), MAX_WORKERS), 1)
+    fetch = fetch_idmapping_results if return_full else fetch_idmapping_hits
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results_list = list(executor.map(fetch, job_ids))
+
+    if conn is not None:
+        for (db, _), pairs in zip(jobs, results_list):
+            write_idmapping_cache(conn, db, pairs)
+        conn.close()
+
+    # if the full results aren't needed, skip building dataframes entirely
+    if not return_full:
+        hits = sorted(
+            {target for pairs in [*results_list, cached_pairs] for _, target in pairs}
+        )
+    else:
+        # the columns are known up front, so skip dtype inference
+        frames = [
+            pd.DataFrame.from_records(pairs, columns=["from", "to"]).astype(
+                {"from": "string", "to": "string"}
+            )
+            for pairs in [*results_list, cached_pairs]
+            if pairs
+        ]
+
+        # drop repeated mappings up front so they aren't carried downstream
+        dummy_df = (
+            pd.concat(frames, axis=0, copy=False, ignore_index=True).drop_duplicates(
+                ignore_index=True
+            )
+            if frames
+            else pd.DataFrame(columns=["from", "to"], dtype="string")
+        )
+
+        # extract just the unique Uniprot accessions
+        hits = sorted(
+            dummy_df.drop_duplicates(subset=["to"], ignore_index=True)["to"].tolist()
+        )
 
     # save those accessions to a .txt file
-    with open(output_file, "w+") as f:
-        f.writelines(hit + "\n" for hit in hits)
+    with open(output_file, "w") as f:
+        f.write("\n".join(hits) + "\n" if hits else "")
 
     if return_full:
         return dummy_df
@@ -202,12 +438,15 @@ def main():
     output_file = args.output
     query_dbs = args.databases
     service = args.service
+    cache_file = args.cache
 
     if service == "bioservices":
-        # send to map_refseqids
-        map_refseqids_bioservices(input_file, output_file, query_dbs)
-    else:
-        map_refseqids_rest(input_file, output_file, query_dbs)
+        warnings.warn(
+            "The bioservices service is deprecated and now uses the REST API.",
+            DeprecationWarning,
+        )
+
+    map_refseqids_rest(input_file, output_file, query_dbs, cache_file=cache_file)
 
 
 # check if called from interpreter